@@ -2,90 +2,776 @@
 
 """
 import argparse
+import collections
+import ctypes
+import ctypes.util
+import errno
+import functools
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
 import os
 import shutil
+import sqlite3
+import struct
+import sys
 import datetime
 import pathlib
-import glob
-from PIL import Image
-from PIL.ExifTags import TAGS
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
 
-def find_images(directory, image_ext='jpg'):
-    """ Returns a list of images at the input directory and subdirectories. """
+# Exif tag id of the DateTime tag
+EXIF_DATETIME_TAG = 0x0132
 
-    return_images = list()
-    pattern = f'*.{image_ext}'
-    print(f'Looking for images in {directory} with extension {image_ext}')
-    # First check the parent directory for any files
-    new_files = glob.glob(os.path.join(directory, pattern))
-    return_images.extend(new_files)
-    # Do the same thing with any subdirectories
-    for dirName, subdirList, fileList in os.walk(directory):
-        if len(subdirList) > 0:
-            for subdir in subdirList:
-                updated_files = find_images(os.path.join(dirName, subdir), image_ext)
-                return_images.extend(updated_files)
+# Extensions whose exif data is read by PIL with enough work that processes scale better than threads
+PROCESS_EXTENSIONS = {'heic', 'tif', 'tiff', 'arw', 'cr2', 'nef'}
 
-    return return_images
+# Number of images processed by a worker process at a time
+PROCESS_CHUNK_SIZE = 32
 
+# Number of threads used for reading and copying images, which is I/O bound
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Number of images between progress messages
+PROGRESS_INTERVAL = 1000
+
+# ioctl request that makes a file share the blocks of another file on Linux (FICLONE)
+FICLONE = 0x40049409
+
+# Results of store_image
+FAILED = 0
+STORED = 1
+ALREADY_STORED = 2
+
+# renameat2 arguments for paths relative to the working directory, and for refusing to replace dst
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+# Number of numbered names tried when an image with the same name is already stored
+MAX_RENAMES = 1000
+
+# Name of an image stored under a numbered name because the plain name was taken, such as IMG_1
+NUMBERED_NAME = re.compile(r'(.+)_\d+')
+
+# Largest difference between modification times that are treated as equal. FAT keeps them to 2 seconds.
+MTIME_RESOLUTION_NS = 2 * 10 ** 9
+
+# Largest number of bytes requested from a single copy_file_range call
+COPY_CHUNK_SIZE = 1 << 30
+
+# Number of new manifest entries written in each transaction
+MANIFEST_BATCH_SIZE = 100
+
+# Default location of the manifest of images organized by previous runs
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'pic_org', 'manifest.sqlite')
+
+# Destination directory for each (storage directory, year, month) seen during this run
+_month_dirs = dict()
+
+# Read only manifest and images already in the storage directory, used by each worker process
+_worker_manifest = None
+_worker_existing = None
+
+logger = logging.getLogger('pic_org')
+
+# Destination directories already created during this run
+_made_dirs = set()
+_made_dirs_lock = threading.Lock()
+
+
+def configure_logger(handler):
+    """ Makes the handler the only destination of the log messages. """
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def start_logging():
+    """ Sends log messages through a queue to a single thread that writes them to stderr.
+
+    The worker threads never wait on the stream while copying. Returns the listener, which must be stopped
+    to write out the remaining messages.
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    configure_logger(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    return listener
+
+
+def make_dirs(directory):
+    """ Creates the directory once per run, skipping the mkdir call if it was already made. """
+    if directory in _made_dirs:
+        return
+    with _made_dirs_lock:
+        if directory not in _made_dirs:
+            os.makedirs(directory, exist_ok=True)
+            _made_dirs.add(directory)
+
+
+class Manifest:
+    """ Records where each source image was stored so that unchanged images can be skipped on later runs.
+
+    The manifest is an sqlite database keyed by the absolute source path and storage directory, so an
+    image stored in one storage directory is not skipped when organizing into another. An entry only
+    matches if the size and modification time of the source are unchanged. The connection is shared by the
+    worker threads. Unless the manifest is read only, new entries are written in batches of
+    MANIFEST_BATCH_SIZE, and the rest when it is closed.
+    """
+
+    def __init__(self, path, storage_directory, readonly=False):
+        self.readonly = readonly
+        self.storage_directory = os.path.abspath(storage_directory)
+        self._lock = threading.Lock()
+        self._records = list()
+        if not readonly:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        elif not os.path.exists(path):
+            self._conn = None
+            return
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if not readonly:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS stored_images '
+                               '(src TEXT, storage TEXT, size INT, mtime REAL, dst TEXT, PRIMARY KEY (src, storage))')
+
+    def lookup(self, src, src_stat):
+        """ Returns the stored destination of src if src is unchanged and the destination exists, else None. """
+        if self._conn is None:
+            return None
+        with self._lock:
+            try:
+                row = self._conn.execute('SELECT size, mtime, dst FROM stored_images WHERE src = ? AND storage = ?',
+                                         (os.path.abspath(src), self.storage_directory)).fetchone()
+            except sqlite3.OperationalError:
+                return None
+        if row is None:
+            return None
+        size, mtime, dst = row
+        if size != src_stat.st_size or mtime != src_stat.st_mtime:
+            return None
+        # Only trust destinations that are still inside this storage directory
+        if not dst.startswith(self.storage_directory + os.sep) or not os.path.exists(dst):
+            return None
+        return dst
+
+    def record(self, src, src_stat, dst):
+        """ Stores the destination of src. """
+        with self._lock:
+            self._records.append((os.path.abspath(src), self.storage_directory, src_stat.st_size,
+                                  src_stat.st_mtime, os.path.abspath(dst)))
+            if len(self._records) >= MANIFEST_BATCH_SIZE:
+                self._write_records()
+
+    def _write_records(self):
+        """ Writes the buffered entries in one transaction. The lock must be held. """
+        if self._conn is None or self.readonly or not self._records:
+            return
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO stored_images VALUES (?, ?, ?, ?, ?)', self._records)
+        self._records = list()
+
+    def close(self):
+        """ Writes the remaining entries and closes the database. """
+        with self._lock:
+            if self._conn is None:
+                return
+            self._write_records()
+            self._conn.close()
+            self._conn = None
+
+
+def scan_dir(directory):
+    """ Returns the DirEntry objects of the subdirectories and files in the directory.
+
+    Symbolic links to directories are treated as files and are not followed.
+    """
+    dirs = list()
+    files = list()
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        logger.error(f'Error: Could not read {directory}.')
+        return dirs, files
+    try:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry)
+            else:
+                files.append(entry)
+    except OSError:
+        logger.error(f'Error: Could not read all of {directory}.')
+    finally:
+        entries.close()
+    return dirs, files
+
+
+def walk(top, threads=1):
+    """ Yields (dirpath, dirs, files) for every directory under top, similar to os.walk.
+
+    dirs and files are lists of DirEntry objects, and the directories are yielded in no particular order.
+    With more than one thread, the directories are read concurrently from a shared last-in first-out
+    list, which hides the latency of each directory read on network filesystems.
+    """
+    top = str(top)
+    if threads <= 1:
+        paths = [top]
+        while paths:
+            path = paths.pop()
+            dirs, files = scan_dir(path)
+            yield path, dirs, files
+            paths.extend(entry.path for entry in dirs)
+        return
+
+    results = queue.Queue()
+    paths = [top]
+    # Number of directories that are either waiting in paths or being read by a worker
+    pending = 1
+    condition = threading.Condition()
+
+    def worker():
+        nonlocal pending
+        try:
+            while True:
+                with condition:
+                    while not paths and pending:
+                        condition.wait()
+                    if not paths:
+                        break
+                    path = paths.pop()
+                dirs = list()
+                try:
+                    dirs, files = scan_dir(path)
+                    results.put((path, dirs, files))
+                finally:
+                    # Always account for the directory, or the other workers would wait forever
+                    with condition:
+                        paths.extend(entry.path for entry in dirs)
+                        pending += len(dirs) - 1
+                        condition.notify_all()
+        finally:
+            results.put(None)
+
+    for _ in range(threads):
+        threading.Thread(target=worker, daemon=True).start()
+
+    running = threads
+    while running:
+        result = results.get()
+        if result is None:
+            running -= 1
+        else:
+            yield result
+
+
+def find_images(directory, image_ext='jpg', threads=1):
+    """ Yields a DirEntry object for each image at the input directory and subdirectories.
+
+    The images are yielded as the directories are read, so they can be processed before the walk finishes.
+    image_ext may be a single extension or a list of extensions, all of which are found in one pass.
+    Matching ignores the case of the extension.
+    """
+
+    if isinstance(image_ext, str):
+        image_ext = [image_ext]
+    suffixes = set()
+    for ext in image_ext:
+        ext = ext.lstrip('.')
+        suffixes.update((f'.{ext.lower()}', f'.{ext.upper()}'))
+    suffixes = tuple(suffixes)
+    logger.info(f'Looking for images in {directory} with extension {", ".join(image_ext)}')
+    for _, _, files in walk(directory, threads):
+        for entry in files:
+            # Checking the common spellings first avoids lowering every name
+            name = entry.name
+            if name.endswith(suffixes) or name.lower().endswith(suffixes):
+                yield entry
+
+
+def same_mtime(stored_ns, source_ns):
+    """ Returns True if a stored file's modification time matches the source, within MTIME_RESOLUTION_NS.
+
+    Filesystems such as FAT and exFAT keep the modification time at a coarser resolution than the source.
+    """
+    return abs(stored_ns - source_ns) < MTIME_RESOLUTION_NS
+
+
+def find_stored_images(storage_directory, threads=1):
+    """ Returns the files already in the storage directory, so that images stored earlier can be skipped.
+
+    The result maps (file name, size) to a list of (modification time in nanoseconds, path). Copies keep
+    the modification time of the source, so a source image with the same name, size and time is already
+    stored. Files stored under a numbered name such as name_1.jpg are listed under name.jpg as well.
+    """
+    existing = dict()
+    if not os.path.isdir(storage_directory):
+        return existing
+    for _, _, files in walk(storage_directory, threads):
+        for entry in files:
+            try:
+                entry_stat = entry.stat()
+            except OSError:
+                continue
+            stored = (entry_stat.st_mtime_ns, entry.path)
+            existing.setdefault((entry.name, entry_stat.st_size), list()).append(stored)
+            stem, ext = os.path.splitext(entry.name)
+            numbered = NUMBERED_NAME.fullmatch(stem)
+            if numbered is not None:
+                existing.setdefault((numbered.group(1) + ext, entry_stat.st_size), list()).append(stored)
+    return existing
+
+
+def parse_exif_datetime(data):
+    """ Parses an exif date string of the form 'YYYY:MM:DD HH:MM:SS' into a UTC datetime.
+
+    The fields are at fixed positions, so they are sliced out directly rather than going through strptime.
+    Returns None if the data is missing or malformed.
+    """
+    if not data:
+        return None
+    try:
+        return datetime.datetime(int(data[0:4]), int(data[5:7]), int(data[8:10]),
+                                 int(data[11:13]), int(data[14:16]), int(data[17:19]),
+                                 tzinfo=datetime.timezone.utc)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def read_jpeg_exif_datetime(image_file):
+    """ Returns the exif DateTime string of a JPEG, or None if the JPEG has none.
+
+    The JPEG markers are read one segment at a time, seeking past the segments before the APP1 exif
+    segment, and the DateTime tag is read straight from the first TIFF image directory without going
+    through PIL. Raises ValueError if the file is not a JPEG.
+    """
+    with open(image_file, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            raise ValueError(f'{image_file} is not a JPEG')
+        while True:
+            if f.read(1) != b'\xff':
+                # End of the file or a corrupt segment
+                return None
+            marker = f.read(1)
+            while marker == b'\xff':
+                # Fill byte
+                marker = f.read(1)
+            if not marker:
+                return None
+            marker = marker[0]
+            if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                # Markers without a length
+                continue
+            if marker in (0xd9, 0xda):
+                # End of image or start of the compressed data, so there is no exif segment
+                return None
+            length_bytes = f.read(2)
+            if len(length_bytes) < 2:
+                return None
+            length, = struct.unpack('>H', length_bytes)
+            if length < 2:
+                return None
+            if marker != 0xe1:
+                f.seek(length - 2, os.SEEK_CUR)
+                continue
+            segment = f.read(length - 2)
+            if segment[:6] == b'Exif\x00\x00':
+                try:
+                    return _read_tiff_datetime(segment[6:])
+                except struct.error:
+                    return None
 
-def rename_image(image_file, storage_directory='.', dryrun=False, verbose=False):
-    """ Extracts the metadata for the given image and puts the file in a folder based on year-month.
+
+def _read_tiff_datetime(tiff):
+    """ Returns the DateTime string from the first image directory of TIFF formatted exif data, or None. """
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+    ifd_offset, = struct.unpack(endian + 'I', tiff[4:8])
+    num_entries, = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])
+    for i in range(num_entries):
+        entry = ifd_offset + 2 + 12 * i
+        tag, tag_type, count = struct.unpack(endian + 'HHI', tiff[entry:entry + 8])
+        # Type 2 is an ASCII string
+        if tag != EXIF_DATETIME_TAG or tag_type != 2:
+            continue
+        if count <= 4:
+            value = tiff[entry + 8:entry + 8 + count]
+        else:
+            value_offset, = struct.unpack(endian + 'I', tiff[entry + 8:entry + 12])
+            value = tiff[value_offset:value_offset + count]
+        try:
+            return value.split(b'\x00', 1)[0].decode('ascii')
+        except UnicodeDecodeError:
+            return None
+    return None
+
+
+def read_exif_datetime(image_file):
+    """ Returns the exif DateTime string of the image, or None if it has none.
+
+    JPEGs are read directly. Other formats fall back to PIL, which only reads the exif data and never
+    loads the pixels. Raises OSError if the image cannot be read.
+    """
+    try:
+        return read_jpeg_exif_datetime(image_file)
+    except ValueError:
+        pass
+    # PIL is only needed for formats other than JPEG
+    from PIL import Image
+    with Image.open(image_file) as oimage:
+        return oimage.getexif().get(EXIF_DATETIME_TAG)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_clonefile():
+    """ Returns the macOS clonefile function, or None if it is not available. """
+    if sys.platform != 'darwin':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clonefile = libc.clonefile
+    except (OSError, AttributeError):
+        return None
+    clonefile.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int)
+    clonefile.restype = ctypes.c_int
+    return clonefile
+
+
+def reflink_file(src, dst, fsrc=None, fdst=None):
+    """ Makes dst a copy-on-write clone of src without copying any data. Returns True if it worked.
+
+    On Linux this uses the FICLONE ioctl on the open files fsrc and fdst, which works on btrfs, XFS and
+    other filesystems with shared extents. On macOS it uses clonefile, which works on APFS but requires
+    that dst does not exist yet.
+    """
+    if fdst is not None:
+        try:
+            import fcntl
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except (ImportError, OSError):
+            return False
+    clonefile = _load_clonefile()
+    if clonefile is None:
+        return False
+    return clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+
+
+def copy_file(src, dst, size):
+    """ Copies the data of src to dst, which is created and must not exist yet.
+
+    A reflink is tried first, which shares the blocks of src when both files are on a copy-on-write
+    filesystem. Otherwise, on Linux the data is copied inside the kernel with copy_file_range, which never
+    passes through user space and lets the filesystem copy on the server side. Other platforms, or
+    filesystems that support neither, copy through a buffer. Raises FileExistsError if dst exists, and
+    removes dst again if the copy fails.
+    """
+    if sys.platform == 'darwin' and reflink_file(src, dst):
+        return
+    with open(src, 'rb') as fsrc:
+        fdst = open(dst, 'xb')
+        try:
+            with fdst:
+                if sys.platform.startswith('linux') and size > 0:
+                    if reflink_file(src, dst, fsrc, fdst):
+                        return
+                    if hasattr(os, 'copy_file_range') and _copy_file_range(fsrc, fdst):
+                        return
+                shutil.copyfileobj(fsrc, fdst)
+        except BaseException:
+            os.remove(dst)
+            raise
+
+
+def _copy_file_range(fsrc, fdst):
+    """ Copies fsrc to fdst with copy_file_range. Returns False if the filesystems do not support it. """
+    copied = 0
+    try:
+        while True:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_CHUNK_SIZE)
+            if n == 0:
+                break
+            copied += n
+        return True
+    except OSError as e:
+        if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                     errno.EPERM, errno.ETXTBSY):
+            raise
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def _load_renameat2():
+    """ Returns the Linux renameat2 function, or None if it is not available. """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return None
+    renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+    renameat2.restype = ctypes.c_int
+    return renameat2
+
+
+def rename_no_replace(src, dst):
+    """ Renames src to dst, raising FileExistsError instead of replacing dst.
+
+    On Linux this uses renameat2 with RENAME_NOREPLACE, which checks and renames in one step. Elsewhere,
+    or if the filesystem does not support it, dst is checked before an ordinary rename.
+    """
+    renameat2 = _load_renameat2()
+    if renameat2 is not None:
+        if renameat2(AT_FDCWD, os.fsencode(src), AT_FDCWD, os.fsencode(dst), RENAME_NOREPLACE) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in (errno.EINVAL, errno.ENOSYS):
+            raise OSError(err, os.strerror(err), src, None, dst)
+    if os.path.exists(dst):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+    os.rename(src, dst)
+
+
+def transfer_file(src, dst, src_stat, move=False):
+    """ Copies or moves src to dst, keeping the modification time of src.
+
+    dst is never overwritten, FileExistsError is raised instead. A move within the same filesystem
+    links src at dst and then removes src, or renames it on filesystems without hard links, so it does not
+    touch the file data. Otherwise the data is copied with copy_file.
+    """
+    if move:
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            raise
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                # The filesystem has no hard links, such as FAT, so rename instead
+                rename_no_replace(src, dst)
+                return
+            # Another filesystem, so copy the data instead
+        else:
+            os.remove(src)
+            return
+    copy_file(src, dst, src_stat.st_size)
+    os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    if move:
+        os.remove(src)
+
+
+def month_dir(storage_directory, date):
+    """ Returns the year/month directory inside the storage directory for the given date. """
+    key = (storage_directory, date.year, date.month)
+    directory = _month_dirs.get(key)
+    if directory is None:
+        directory = f'{storage_directory}{os.sep}{date.year}{os.sep}{date.strftime("%B")}'
+        _month_dirs[key] = directory
+    return directory
+
+
+def plan_image(image_file, storage_directory='.', verbose=False, manifest=None, existing=None):
+    """ Extracts the metadata for the given image and works out the year-month folder it belongs in.
 
     https://stackoverflow.com/questions/237079/how-do-i-get-file-creation-and-modification-date-times
     fname = pathlib.Path('test.py')
     ctime = datetime.datetime.fromtimestamp(fname.stat().st_ctime, tz=datetime.timezone.utc)
     mtime = datetime.datetime.fromtimestamp(fname.stat().st_mtime, tz=datetime.timezone.utc)
 
-    Returns 1 if the file was copied successfully, 0 otherwise
+    image_file may be a path or a DirEntry from find_images, whose name and path are reused.
+    existing is the result of find_stored_images for the storage directory.
+
+    Returns an (image path, stat result, destination folder, destination path) tuple to pass to store_image,
+    or None if the image could not be read. If the manifest or existing shows that the image is already
+    stored, the destination folder is None.
     """
     # Store the file name
-    file_name = os.path.basename(image_file)
+    if isinstance(image_file, os.DirEntry):
+        file_name = image_file.name
+        image_path = image_file.path
+    else:
+        image_path = os.fspath(image_file)
+        file_name = os.path.basename(image_path)
 
     if verbose:
-        print(f'Processing {file_name}.')
-    # Read the image data using PIL
+        logger.info(f'Processing {file_name}.')
     try:
-        oimage = Image.open(image_file)
+        file_stat = image_file.stat() if isinstance(image_file, os.DirEntry) else os.stat(image_path)
     except OSError:
-        print(f'Error: Could not open {image_file}.')
-        return 0
-    fname = pathlib.Path(image_file)
-    ctime = datetime.datetime.fromtimestamp(fname.stat().st_ctime, tz=datetime.timezone.utc)
-    mtime = datetime.datetime.fromtimestamp(fname.stat().st_mtime, tz=datetime.timezone.utc)
+        logger.error(f'Error: Could not open {image_path}.')
+        return None
+    if manifest is not None:
+        stored = manifest.lookup(image_path, file_stat)
+        if stored is not None:
+            if verbose:
+                logger.info(f'Skipping {image_path}, already stored at {stored}')
+            return image_path, file_stat, None, stored
+    if existing is not None:
+        for stored_mtime_ns, stored_path in existing.get((file_name, file_stat.st_size), ()):
+            if same_mtime(stored_mtime_ns, file_stat.st_mtime_ns):
+                if verbose:
+                    logger.info(f'Skipping {image_path}, already stored at {stored_path}')
+                return image_path, file_stat, None, stored_path
+    try:
+        exif_date = read_exif_datetime(image_path)
+    except OSError:
+        logger.error(f'Error: Could not open {image_path}.')
+        return None
+    ctime = datetime.datetime.fromtimestamp(file_stat.st_ctime, tz=datetime.timezone.utc)
+    mtime = datetime.datetime.fromtimestamp(file_stat.st_mtime, tz=datetime.timezone.utc)
     earliest_date = min(ctime, mtime)
-    # Extract exif data
-    exifdata = oimage.getexif()
-    if exifdata:
-        for tag_id in exifdata:
-            # Get the tag name
-            tag = TAGS.get(tag_id, tag_id)
-            if tag is not str:
-                continue
-            data = exifdata.get(tag_id)
-            # Only use the datetime tag
-            if tag.lower() == 'datetime':
-                try:
-                    parsed_date = datetime.datetime.strptime(data, '%Y:%m:%d %H:%M:%S')
-                except ValueError:
-                    parsed_date = datetime.datetime.today()
-                parsed_date = datetime.datetime.combine(parsed_date, datetime.time.min, tzinfo=datetime.timezone.utc)
-                earliest_date = min(earliest_date, parsed_date)
-    month = earliest_date.strftime('%B')
-    place_to_store = os.path.join(storage_directory, f'{earliest_date.year}', f'{month}', file_name)
+    # Only use the datetime tag
+    parsed_date = parse_exif_datetime(exif_date)
+    if parsed_date is not None:
+        earliest_date = min(earliest_date, parsed_date)
+    parent_dir = month_dir(storage_directory, earliest_date)
+    return image_path, file_stat, parent_dir, f'{parent_dir}{os.sep}{file_name}'
+
+
+def store_image(plan, dryrun=False, verbose=False, move=False, manifest=None):
+    """ Copies (or moves) an image to the destination worked out by plan_image.
+
+    An image already at the destination, or at a numbered name for it, with the same size and modification
+    time is not copied again. If a manifest is given, the stored image is added to it.
+
+    Returns STORED if the file was copied (or moved) successfully, ALREADY_STORED if it was already in the
+    storage directory, or FAILED otherwise
+    """
+    if plan is None:
+        return FAILED
+    image_path, file_stat, parent_dir, place_to_store = plan
+    if parent_dir is None:
+        return ALREADY_STORED
 
     if verbose:
-        print(f'Copying {image_file} to {place_to_store}')
+        logger.info(f'{"Moving" if move else "Copying"} {image_path} to {place_to_store}')
     if dryrun:
-        return 1
-    os.makedirs(os.path.dirname(place_to_store), exist_ok=True)
-    try:
-        shutil.copy(image_file, place_to_store)
-    except PermissionError as e:
-        print(f'Could not move {image_file} to {place_to_store}: {e}')
-        return 0
-    return 1
+        return STORED
+    make_dirs(parent_dir)
+    stem, ext = os.path.splitext(place_to_store)
+    num_renames = 0
+    while True:
+        try:
+            transfer_file(image_path, place_to_store, file_stat, move=move)
+            break
+        except FileExistsError:
+            try:
+                stored_stat = os.stat(place_to_store)
+            except OSError:
+                stored_stat = None
+            if (stored_stat is not None and stored_stat.st_size == file_stat.st_size
+                    and same_mtime(stored_stat.st_mtime_ns, file_stat.st_mtime_ns)):
+                if verbose:
+                    logger.info(f'Skipping {image_path}, already stored at {place_to_store}')
+                if manifest is not None:
+                    manifest.record(image_path, file_stat, place_to_store)
+                return ALREADY_STORED
+            # Never overwrite another image with the same name, store this one under a numbered name instead
+            num_renames += 1
+            if num_renames > MAX_RENAMES:
+                logger.error(f'Could not move {image_path}: too many files named like {place_to_store}')
+                return FAILED
+            place_to_store = f'{stem}_{num_renames}{ext}'
+            if verbose:
+                logger.info(f'Destination exists, storing {image_path} as {place_to_store}')
+        except OSError as e:
+            logger.error(f'Could not move {image_path} to {place_to_store}: {e}')
+            return FAILED
+    if manifest is not None:
+        manifest.record(image_path, file_stat, place_to_store)
+    return STORED
+
+
+def rename_image(image_file, storage_directory='.', dryrun=False, verbose=False, move=False, manifest=None,
+                 existing=None):
+    """ Extracts the metadata for the given image and puts the file in a folder based on year-month.
+
+    If a manifest is given, images it lists as already stored are skipped and newly stored images are added.
+    Images found in existing, the result of find_stored_images, are skipped as well.
+
+    Returns 1 if the file was copied (or moved) successfully or was already stored, 0 otherwise
+    """
+    plan = plan_image(image_file, storage_directory, verbose=verbose, manifest=manifest, existing=existing)
+    result = store_image(plan, dryrun=dryrun, verbose=verbose, move=move, manifest=manifest)
+    return 0 if result == FAILED else 1
+
+
+def _init_worker(cache, storage_directory, existing):
+    """ Opens the manifest and sets up logging in a worker process. """
+    global _worker_manifest, _worker_existing
+    _worker_existing = existing
+    # The queue of the parent's log listener is not shared with the worker, so write to stderr directly
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter('%(message)s'))
+    configure_logger(stream_handler)
+    if cache is not None:
+        _worker_manifest = Manifest(cache, storage_directory, readonly=True)
+
+
+def plan_image_worker(task):
+    """ Runs plan_image in a worker process.
+
+    task is a picklable (image path, storage directory, verbose) tuple.
+    """
+    image_file, storage_directory, verbose = task
+    return plan_image(image_file, storage_directory, verbose=verbose, manifest=_worker_manifest,
+                      existing=_worker_existing)
+
+
+def bounded_submit(submit, items, limit):
+    """ Yields submit(item) for each item, in order, once it is the oldest of at most limit submissions.
+
+    The caller waits on each yielded future before the next item is submitted, so only limit items are
+    taken from items ahead of the results. This keeps a large or streamed input from being queued whole.
+    """
+    in_flight = collections.deque()
+    for item in items:
+        if len(in_flight) >= limit:
+            yield in_flight.popleft()
+        in_flight.append(submit(item))
+    while in_flight:
+        yield in_flight.popleft()
+
+
+def plan_images(images, storage_directory='.', verbose=False, manifest=None, existing=None, processes=False,
+                cache=None):
+    """ Yields the result of plan_image for each image, reading the images concurrently.
+
+    With processes, the images are read in chunks by a pool of worker processes which open the manifest at
+    cache themselves. Otherwise they are read by a pool of threads sharing the given manifest. Only a few
+    images per worker are taken from images ahead of the results.
+    """
+    if processes:
+        num_processes = os.cpu_count() or 1
+        tasks = ((os.fspath(image), storage_directory, verbose) for image in images)
+        chunks = iter(lambda: list(itertools.islice(tasks, PROCESS_CHUNK_SIZE)), [])
+        with multiprocessing.Pool(num_processes, initializer=_init_worker,
+                                  initargs=(cache, storage_directory, existing)) as pool:
+            for result in bounded_submit(
+                    lambda chunk: pool.map_async(plan_image_worker, chunk, chunksize=len(chunk)),
+                    chunks, 2 * num_processes):
+                yield from result.get()
+    else:
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            for future in bounded_submit(
+                    lambda image: executor.submit(plan_image, image, storage_directory, verbose=verbose,
+                                                  manifest=manifest, existing=existing),
+                    images, 4 * IO_WORKERS):
+                yield future.result()
 
 
 if __name__ == "__main__":
@@ -97,28 +783,113 @@ if __name__ == "__main__":
                         type=pathlib.Path)
     parser.add_argument('storage_directory', help='Directory where images will be stored.',
                         type=pathlib.Path)
-    parser.add_argument('-f', '--filetype',
-                        help='Extension to search for. Default is jpg', type=str, default='jpg')
-    parser.add_argument('-d', '--dryrun',
-                        help='If true, only prints to screen what files would be moved to.', type=bool, default=False)
-    parser.add_argument('-v', '--verbose',
-                        help='If True, prints additional information to screen, such as file names.', type=bool,
-                        default=False)
+    parser.add_argument('-f', '--filetype', type=lambda exts: [ext for ext in exts.split(',') if ext],
+                        default=['jpg'],
+                        help='Extension to search for, or several separated by commas such as jpg,png. '
+                             'Default is jpg')
+    parser.add_argument('-d', '--dryrun', action='store_true',
+                        help='Only prints to screen what files would be moved to.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Prints additional information to screen, such as file names.')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='Number of threads used to search for images. More threads help on network drives. '
+                             'Default is 1')
+    parser.add_argument('-m', '--move', action='store_true',
+                        help='Move images instead of copying them. Moves within the same filesystem do not copy '
+                             'any data.')
+    parser.add_argument('-c', '--cache', type=pathlib.Path, default=DEFAULT_CACHE,
+                        help='Manifest of images organized by previous runs. Unchanged images listed in it are '
+                             f'skipped. Default is {DEFAULT_CACHE}')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or update the manifest of previous runs.')
 
     args = parser.parse_args()
 
-    found_images = find_images(args.starting_directory, args.filetype)
+    log_listener = start_logging()
+
+    # Images already in the storage directory from an earlier run are skipped
+    existing = find_stored_images(args.storage_directory, args.threads)
 
-    print(f'Found {len(found_images)} images. Processing.')
+    found_images = find_images(args.starting_directory, args.filetype, args.threads)
 
-    tot_moved = 0
+    manifest = None if args.no_cache else Manifest(args.cache, args.storage_directory, readonly=args.dryrun)
+
+    # The manifest is closed even if the run is interrupted, so the images stored so far are recorded
+    try:
+        # Reading exif data from these formats is CPU bound in PIL, so use processes to avoid the GIL
+        use_processes = any(ext.lower().lstrip('.') in PROCESS_EXTENSIONS for ext in args.filetype)
+
+        # Show progress bars when tqdm is installed, unless every image is already being logged
+        show_progress = tqdm is not None and not args.verbose
+
+        # First read the date of every image as it is found, and group the images by destination folder
+        buckets = dict()
+        num_found = 0
+        num_skipped = 0
+        tot_moved = 0
+        reading = tqdm(desc='Reading images', unit=' images', mininterval=0.1) if show_progress else None
+        for plan in plan_images(found_images, args.storage_directory, verbose=args.verbose, manifest=manifest,
+                                existing=existing, processes=use_processes,
+                                cache=None if args.no_cache else args.cache):
+            num_found += 1
+            if reading is not None:
+                reading.update()
+            elif num_found % PROGRESS_INTERVAL == 0:
+                logger.info(f'Read {num_found} images.')
+            if plan is None:
+                continue
+            if plan[2] is None:
+                # Already stored in this storage directory by a previous run
+                num_skipped += 1
+                continue
+            buckets.setdefault(plan[2], list()).append(plan)
+        if reading is not None:
+            reading.close()
 
-    for image in found_images:
-        num_moved = rename_image(image, args.storage_directory, dryrun=args.dryrun, verbose=args.verbose)
-        tot_moved += num_moved
+        # Then copy the images folder by folder, which keeps the writes for each folder together on the
+        # destination. Copying is I/O bound, so overlap the work for several images at once, across folders.
+        num_to_store = sum(len(plans) for plans in buckets.values())
+        storing = None
+        if show_progress:
+            storing = tqdm(total=num_to_store, desc='Storing images', unit=' images', mininterval=0.1)
+        folder_counts = dict()
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            ordered_plans = ((parent_dir, plan) for parent_dir, plans in buckets.items() for plan in plans)
+            for parent_dir, future in bounded_submit(
+                    lambda item: (item[0], executor.submit(store_image, item[1], dryrun=args.dryrun,
+                                                           verbose=args.verbose, move=args.move,
+                                                           manifest=manifest)),
+                    ordered_plans, 4 * IO_WORKERS):
+                result = future.result()
+                if result == STORED:
+                    tot_moved += 1
+                    folder_counts[parent_dir] = folder_counts.get(parent_dir, 0) + 1
+                elif result == ALREADY_STORED:
+                    num_skipped += 1
+                if storing is not None:
+                    storing.update()
+        if args.verbose:
+            for parent_dir, plans in buckets.items():
+                logger.info(f'Stored {folder_counts.get(parent_dir, 0)} of {len(plans)} images in {parent_dir}')
+        if storing is not None:
+            storing.close()
+    finally:
+        if manifest is not None:
+            manifest.close()
+        # Write out the queued messages, which include any errors that led here
+        log_listener.stop()
 
-    msg = f'Copied {tot_moved} images to {args.storage_directory}'
-    if tot_moved == len(found_images):
-        msg += f'\n\tAll images were copied. Safe to delete {args.starting_directory}.'
+    print(f'Found {num_found} images.')
+    if num_skipped:
+        print(f'Skipped {num_skipped} images already stored in {args.storage_directory}.')
+    if args.move:
+        msg = f'Moved {tot_moved} images to {args.storage_directory}'
+        if num_skipped:
+            msg += f'\n\tThe {num_skipped} images already stored were left in {args.starting_directory}.'
+    else:
+        msg = f'Copied {tot_moved} images to {args.storage_directory}'
+        if tot_moved + num_skipped == num_found:
+            copied = 'were copied' if not num_skipped else 'are stored'
+            msg += f'\n\tAll images {copied}. Safe to delete {args.starting_directory}.'
 
     print(msg)